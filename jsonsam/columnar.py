@@ -0,0 +1,139 @@
+'''
+Copyright (c) 2021 Eric D. Cohen
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+'''
+
+import re
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from .jsonsam import DictSam
+
+# Leaf type codes
+LEAF_NULL = 0
+LEAF_BOOL = 1
+LEAF_NUMBER = 2
+LEAF_STRING = 3
+
+class ColumnarSam:
+    '''
+    Columnar view of the denormalized paths of a DictSam for vectorized
+    filtering.  Predicates return numpy boolean masks over the paths, which
+    can be combined with &, | and ~ and then passed to select().  Requires
+    numpy.
+
+    Columns (one row per path):
+    depth -- Number of keys in the path
+    leaf_type -- One of the LEAF_* type codes
+    number -- Numeric leaf value, NaN for non-numeric leaves
+    string -- String leaf value, None for non-string leaves
+    key_ids -- Matrix of key IDs (see keys) padded with -1 to the max depth
+    '''
+    def __init__(self, dict_sam):
+        if np is None:
+            raise ImportError('The numpy package is required for ColumnarSam')
+        self.paths = dict_sam.denormalize()
+        num_paths = len(self.paths)
+        self.depth = np.fromiter((len(x) - 1 for x in self.paths), dtype=np.int32,
+                                 count=num_paths)
+        max_depth = int(self.depth.max()) if num_paths else 0
+
+        # Keys are typed so that list index 0 and dictionary key "0" differ
+        self.keys = []
+        self._key_ids = {}
+        rows = []
+        for path in self.paths:
+            row = [self._key_id(x) for x in path[:-1]]
+            rows.append(row + [-1] * (max_depth - len(row)))
+        self.key_ids = np.array(rows, dtype=np.int32).reshape(num_paths, max_depth)
+
+        leaves = [x[-1] for x in self.paths]
+        leaf_types = [self._leaf_type(x) for x in leaves]
+        self.leaf_type = np.array(leaf_types, dtype=np.int8)
+        self.number = np.full(num_paths, np.nan)
+        self.number[self.leaf_type == LEAF_NUMBER] = \
+            [x for (x, y) in zip(leaves, leaf_types) if y == LEAF_NUMBER]
+        self.string = np.array(leaves, dtype=object)
+        self.string[self.leaf_type != LEAF_STRING] = None
+
+    def __len__(self):
+        return len(self.paths)
+
+    def _key_id(self, key):
+        ''' Get the ID of a key, assigning a new ID if unseen '''
+        typed_key = (type(key), key)
+        key_id = self._key_ids.get(typed_key)
+        if key_id is None:
+            key_id = self._key_ids[typed_key] = len(self.keys)
+            self.keys.append(key)
+        return key_id
+
+    @staticmethod
+    def _leaf_type(leaf):
+        ''' Map a leaf value to its type code '''
+        if leaf is None:
+            return LEAF_NULL
+        if isinstance(leaf, bool):
+            return LEAF_BOOL
+        if isinstance(leaf, (int, float)):
+            return LEAF_NUMBER
+        return LEAF_STRING
+
+    def prefix(self, *keys):
+        '''
+        Mask of paths starting with keys
+        '''
+        mask = self.depth >= len(keys)
+        if len(keys) > self.key_ids.shape[1]:
+            return np.zeros(len(self), dtype=bool)
+        for col, key in enumerate(keys):
+            key_id = self._key_ids.get((type(key), key))
+            if key_id is None:
+                return np.zeros(len(self), dtype=bool)
+            mask &= self.key_ids[:, col] == key_id
+        return mask
+
+    def match(self, pattern):
+        '''
+        Mask of paths whose string leaf matches the regular expression
+        pattern (re.search semantics).  Each distinct string is only
+        evaluated once.
+        '''
+        regex = re.compile(pattern)
+        mask = np.zeros(len(self), dtype=bool)
+        is_string = self.leaf_type == LEAF_STRING
+        strings = self.string[is_string]
+        # De-duplicate with a dict rather than a fixed width unicode array,
+        # whose size would scale with the longest string
+        uniques = {}
+        inverse = np.fromiter((uniques.setdefault(x, len(uniques)) for x in strings),
+                              dtype=np.intp, count=len(strings))
+        matches = np.array([bool(regex.search(x)) for x in uniques], dtype=bool)
+        mask[is_string] = matches[inverse]
+        return mask
+
+    def select(self, mask):
+        '''
+        Returns a DictSam of the paths selected by a boolean mask
+        '''
+        return DictSam([self.paths[x] for x in np.flatnonzero(mask)], denormed=True)
@@ -22,9 +22,15 @@ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 SOFTWARE.
 '''
 
+import io
+import sys
+import zlib
 import json
+import time
 import random
 import argparse
+import itertools
+import contextlib
 import collections
 from pathlib import Path
 
@@ -32,18 +38,54 @@ from pathlib import Path
 STDIN = Path('/dev/stdin')
 STDOUT = Path('/dev/stdout')
 
+SPLIT_STRATEGIES = ('roundrobin', 'hash', 'size')
+DENORM_BATCH_LINES = 4096
+WATCH_INTERVAL = 0.5
+OUTPUT_CHUNK_SIZE = 1 << 16
+COMPACT_ENCODE_ITEMS = 4096
+COMPRESSED_SUFFIXES = ('.gz', '.bz2', '.xz', '.zst')
+
+def _write_norm_shard(args):
+    '''
+    Normalize a list of paths and write the result to a JSON file.  Module
+    level so it can be dispatched to worker processes.
+    '''
+    (paths, outpath, enforce_unique, indent, sort_keys) = args
+    DictSam.enforce_unique = enforce_unique
+    # Round trip through JSON as JsonSam does, which coerces the int keys of
+    # dicts mixing list indices and keys to strings so they can be sorted
+    data = json.loads(json.dumps(DictSam.normalize(paths)))
+    JsonSam.dump_normed(data, outpath, indent, sort_keys)
+    return outpath
+
+def _normalize_partition(args):
+    '''
+    Normalize a partition of paths whose top-level keys are not shared with
+    any other partition.  Returns a list of (top-level key, normalized
+    subtree) tuples.  Module level so it can be dispatched to worker
+    processes.
+    '''
+    (paths, enforce_unique) = args
+    DictSam.enforce_unique = enforce_unique
+    pure_dict = DictSam._normalize_pure(paths)
+    # Wrap each subtree under a non-integer key so it is restored exactly as
+    # it would be within the full tree
+    return [(key, DictSam._restore_lists({'_': value})['_'])
+            for (key, value) in pure_dict.items()]
+
 class DictSam:
     '''
     Dictionary split and merge (DICTSAM) main class.
     '''
     ignore_leaves = False
     enforce_unique = False
-    def __init__(self, data=None, denormed=False, enforce_unique=False, enforce_serdes=True):
+    def __init__(self, data=None, denormed=False, enforce_unique=False, enforce_serdes=True,
+                 jobs=1):
         DictSam.enforce_unique = enforce_unique
         if not isinstance(data, (dict, list, type(None))):
             raise TypeError("Data must contain root of dictionary or list type")
         if denormed:
-            self._data = self.normalize(data)
+            self._data = self.normalize(data, jobs)
         else:
             self._data = data
         if enforce_serdes:
@@ -73,16 +115,64 @@ class DictSam:
                     helper(value, curr_path + [idx])
             else:
                 denormed.append(curr_path + [data])
-        if data:
+        if data is not None:
             helper(data)
         else:
             helper(self._data)
         return denormed
 
     @classmethod
-    def normalize(cls, data):
+    def normalize(cls, data, jobs=1):
         '''
         Convert a list of lists of paths into a nested dictionary
+
+        jobs -- Number of worker processes.  If greater than one, paths are
+        partitioned on their top-level key and normalized in parallel.
+        '''
+        if jobs > 1:
+            return cls._normalize_parallel(data, jobs)
+        return cls._restore_lists(cls._normalize_pure(data))
+
+    @classmethod
+    def _normalize_parallel(cls, data, jobs):
+        '''
+        Normalize partitions of paths grouped by top-level key in worker
+        processes and assemble the resulting subtrees.  Path order is
+        preserved within each top-level key, so overwrites resolve exactly as
+        in a serial normalization.
+        '''
+        groups = {}
+        for path in data:
+            groups.setdefault(path[0], []).append(path)
+        if len(groups) < 2:
+            return cls._restore_lists(cls._normalize_pure(data))
+
+        # Several partitions per worker to even out load across subtrees
+        part_size = max(1, len(data) // (jobs * 4))
+        work = [[]]
+        for group in groups.values():
+            if len(work[-1]) >= part_size:
+                work.append([])
+            work[-1] += group
+        import multiprocessing
+        root = {}
+        with multiprocessing.Pool(min(jobs, len(work))) as pool:
+            for subtrees in pool.imap(_normalize_partition,
+                                      [(x, cls.enforce_unique) for x in work]):
+                root.update(subtrees)
+
+        if root and all([cls._is_int(x) for x in root.keys()]):
+            mixed = [None] * (max(root.keys()) + 1)
+            for (key, value) in root.items():
+                mixed[key] = value
+            return mixed
+        return root
+
+    @classmethod
+    def _normalize_pure(cls, data):
+        '''
+        Convert a list of lists of paths into a pure nested dictionary (list
+        indices remain integer keys)
         '''
         nested_dict = lambda: collections.defaultdict(nested_dict)
         cursor = cursor_root = collections.defaultdict(nested_dict)
@@ -100,7 +190,47 @@ class DictSam:
                 cursor = cursor[key]
             cursor_prev[key] = path[-1]
             cursor = cursor_root
-        return cls._restore_lists(cursor_root)
+        return cursor_root
+
+    @staticmethod
+    def _insert_pure(pure_dict, path):
+        '''
+        Insert a path into a pure nested dictionary.  Returns False without
+        completing the insert if the path would overwrite an existing path.
+        '''
+        cursor = pure_dict
+        for key in path[:-2]:
+            if key not in cursor:
+                cursor[key] = {}
+            cursor = cursor[key]
+            if not isinstance(cursor, dict):
+                return False
+        if path[-2] in cursor:
+            return False
+        cursor[path[-2]] = path[-1]
+        return True
+
+    @staticmethod
+    def _remove_pure(pure_dict, path):
+        '''
+        Remove a path from a pure nested dictionary, pruning emptied parents.
+        Returns False if the path is not present with the same leaf value.
+        '''
+        parents = []
+        cursor = pure_dict
+        for key in path[:-1]:
+            if not isinstance(cursor, dict) or key not in cursor:
+                return False
+            parents.append((cursor, key))
+            cursor = cursor[key]
+        if isinstance(cursor, dict) or json.dumps(cursor) != json.dumps(path[-1]):
+            return False
+        while parents:
+            (cursor, key) = parents.pop()
+            del cursor[key]
+            if cursor:
+                break
+        return True
 
     def random_dict_pick(self, pct_pick):
         '''
@@ -115,6 +245,140 @@ class DictSam:
         denorm = random.sample(denorm, num_picks)
         return DictSam(denorm, denormed=True)
 
+    def split(self, num_shards, strategy='roundrobin'):
+        '''
+        Returns a list of DictSams with paths distributed across shards.
+
+        num_shards -- Number of shards to split into
+        strategy -- "roundrobin", "hash" (keeps top-level subtrees together)
+        or "size" (balances serialized bytes per shard)
+        '''
+        shards = self.shard_paths(self.denormalize(), num_shards, strategy)
+        return [DictSam(x, denormed=True) for x in shards]
+
+    @classmethod
+    def shard_paths(cls, paths, num_shards, strategy='roundrobin', prefix_len=1):
+        '''
+        Distribute a list of paths across num_shards lists in a single pass.
+        All elements of a list are kept in the same shard, so normalizing a
+        shard never pads a list with Nones and merging the shards restores
+        the lists exactly.  Consequently a root list is never split.  Paths
+        within the same list must be contiguous, as they are in sorted or
+        denormalize() order.
+
+        paths -- List of denormalized paths
+        num_shards -- Number of output lists
+        strategy -- One of SPLIT_STRATEGIES
+        prefix_len -- Number of leading path elements hashed by "hash"
+        '''
+        if num_shards < 1:
+            raise ValueError("Number of shards must be at least 1")
+        if strategy not in SPLIT_STRATEGIES:
+            raise NotImplementedError('Invalid split strategy "{}"'.format(strategy))
+        shards = [[] for _ in range(num_shards)]
+        sizes = [0] * num_shards
+        cycle = itertools.cycle(range(num_shards))
+        (last_unit, idx) = (None, 0)
+        for path in paths:
+            unit = path[:cls._shard_unit_len(path)]
+            if strategy == 'hash':
+                # crc32 rather than hash() so shards are stable across runs
+                digest = zlib.crc32(json.dumps(unit[:prefix_len]).encode())
+                idx = digest % num_shards
+            elif unit != last_unit:
+                if strategy == 'roundrobin':
+                    idx = next(cycle)
+                else:
+                    idx = min(range(num_shards), key=sizes.__getitem__)
+                last_unit = unit
+            shards[idx].append(path)
+            if strategy == 'size':
+                sizes[idx] += len(json.dumps(path))
+        return shards
+
+    @classmethod
+    def _shard_unit_len(cls, path):
+        '''
+        Length of the path prefix preceding its first list index (including
+        integer strings, which normalize into lists), or of the whole key
+        path if it has no list index
+        '''
+        for (idx, key) in enumerate(path[:-1]):
+            if isinstance(key, int) or (isinstance(key, str) and
+                                        key.lstrip()[:1] in '+-0123456789' and
+                                        cls._is_int(key)):
+                return idx
+        return len(path) - 1
+
+    @classmethod
+    def _check_unique(cls, paths):
+        '''
+        Raise the RuntimeError normalize() would raise under enforce_unique
+        for the same paths, without building the tree
+        '''
+        leaves = set()
+        for path in paths:
+            keys = tuple(path[:-1])
+            if any([keys[:x] in leaves for x in range(1, len(keys) + 1)]):
+                raise RuntimeError('Path "{}" overwrites existing path'
+                                   .format('.'.join([str(x) for x in path])))
+            leaves.add(keys)
+
+    def diff(self, other):
+        '''
+        Structural diff of self (old) against other (new).  See diff_paths.
+        '''
+        return self.diff_paths(self.denormalize(), other.denormalize())
+
+    @classmethod
+    def diff_paths(cls, left, right):
+        '''
+        Diff two lists of paths in a single merge pass over paths sorted by
+        key prefix.  Returns a list of ("-", path) and ("+", path) tuples.  A
+        changed leaf is a removal immediately followed by an addition with
+        the same key prefix.  Leaf changes are ignored if ignore_leaves is set.
+
+        left -- Old list of denormalized paths
+        right -- New list of denormalized paths
+        '''
+        decorate = lambda paths: sorted([(json.dumps(x[:-1]), json.dumps(x[-1]), x)
+                                         for x in paths], key=lambda x: x[:2])
+        left = decorate(left)
+        right = decorate(right)
+        ret = []
+        (lidx, ridx) = (0, 0)
+        while lidx < len(left) or ridx < len(right):
+            if ridx == len(right) or (lidx < len(left) and left[lidx][0] < right[ridx][0]):
+                ret.append(('-', left[lidx][2]))
+                lidx += 1
+            elif lidx == len(left) or right[ridx][0] < left[lidx][0]:
+                ret.append(('+', right[ridx][2]))
+                ridx += 1
+            else:
+                # Same key prefix on both sides, compare the leaves
+                (lend, rend) = (lidx, ridx)
+                while lend < len(left) and left[lend][0] == left[lidx][0]:
+                    lend += 1
+                while rend < len(right) and right[rend][0] == right[ridx][0]:
+                    rend += 1
+                lgroup = left[lidx:lend]
+                rgroup = right[ridx:rend]
+                if cls.ignore_leaves:
+                    removed = [x[2] for x in lgroup[len(rgroup):]]
+                    added = [x[2] for x in rgroup[len(lgroup):]]
+                else:
+                    lleaves = {x[1] for x in lgroup}
+                    rleaves = {x[1] for x in rgroup}
+                    removed = [x[2] for x in lgroup if x[1] not in rleaves]
+                    added = [x[2] for x in rgroup if x[1] not in lleaves]
+                for (rem, add) in zip(removed, added):
+                    ret += [('-', rem), ('+', add)]
+                npaired = min(len(removed), len(added))
+                ret += [('-', x) for x in removed[npaired:]]
+                ret += [('+', x) for x in added[npaired:]]
+                (lidx, ridx) = (lend, rend)
+        return ret
+
     def get_data(self):
         ''' Get data dictionary '''
         return self._data
@@ -225,21 +489,52 @@ class JsonSam(DictSam):
     '''
     JSON split and merge (DICTSAM) main class.
     '''
-    def __init__(self, fname, fname_aux=None, ignore_leaves=False, enforce_unique=False):
+    def __init__(self, fname, fname_aux=None, ignore_leaves=False, enforce_unique=False,
+                 compact=False, sort_keys=False, jobs=1, watch=False):
+        # When watching, the initial load also seeds the watch state
+        self.watch_seed = [None, []] if watch else None
         (denormed_input, data) = self._load_data(fname)
-        super().__init__(data, True, enforce_unique)
+        # Normalization is deferred to the first use of _data, so the
+        # DictSam constructor is bypassed
+        DictSam.enforce_unique = enforce_unique
+        self.jobs = jobs
+        self._normed = None
         self.donorm = denormed_input
         self.denorm_accum = data
         self.is_std = False
+        self.indent = None if compact else 2
+        self.sort_keys = sort_keys
         if fname_aux and fname_aux[0]:
-            self.json_sam_aux = JsonSam(fname_aux, enforce_unique=enforce_unique)
+            self.json_sam_aux = JsonSam(fname_aux, enforce_unique=enforce_unique, jobs=jobs)
 
         self.set_ignore_leaves(ignore_leaves)
 
-    def process(self, fname, fname_aux=None, outfile=None, set_op=None):
+    @property
+    def _data(self):
+        '''
+        Normalized data, built on first access.  Operations on paths alone
+        (split, diff and denormalized output) never normalize their input.
+        '''
+        if self._normed is None:
+            self._normed = json.loads(json.dumps(self.normalize(self.denorm_accum, self.jobs)))
+        return self._normed
+
+    def process(self, fname, fname_aux=None, outfile=None, set_op=None, merge=False,
+                num_shards=None, strategy='roundrobin'):
         '''
         Process a normalized or denormalized JSON file
+
+        merge -- Always write normalized output, regardless of input form
+        num_shards -- Split paths into this many normalized output files
+        strategy -- Path distribution strategy used for splitting
         '''
+        if num_shards is not None:
+            if set_op:
+                raise NotImplementedError('Split cannot be combined with "{}" operation'
+                                          .format(set_op))
+            self._write_split(fname, outfile, num_shards, strategy)
+            return
+
         if fname[0] == STDIN and not outfile:
             self.is_std = True
             mkfn = lambda f, s: STDOUT
@@ -248,9 +543,13 @@ class JsonSam(DictSam):
             if outfile == STDOUT:
                 self.is_std = True
         else:
-            mkfn = lambda f, s: f.parent / Path(f.stem + s).with_suffix(f.suffix)
+            mkfn = self._derive_path
 
-        if fname_aux[0]:
+        if fname_aux[0] and set_op == 'diff':
+            patch = self.diff_paths(self.denorm_accum, self.json_sam_aux.denorm_accum)
+            outpath = mkfn(fname[0], '-diff')
+            self._write_patch(patch, outpath)
+        elif fname_aux[0]:
             ret = self._do_set_op(set_op)
             outpath = mkfn(fname[0], '-norm')
             self._write_normed(ret.get_data(), outpath)
@@ -258,7 +557,7 @@ class JsonSam(DictSam):
             if set_op:
                 raise NotImplementedError('Operand file (-F) required for "{}" operation'
                                           .format(set_op))
-            if self.donorm:
+            if self.donorm or merge:
                 outpath = mkfn(fname[0], '-norm')
                 self._write_normed(self.get_data(), outpath)
             else:
@@ -275,6 +574,142 @@ class JsonSam(DictSam):
 
         raise NotImplementedError('Invalid set operation "{}"'.format(set_op))
 
+    def watch(self, fname, outfile=None, interval=WATCH_INTERVAL):
+        '''
+        Poll a denormalized file and rewrite its normalized output each time
+        it changes.  Only lines added or removed since the previous version
+        are parsed and applied to the in-memory tree.  Runs until interrupted.
+
+        Note keys added by edits are appended to their parent, so key order
+        may differ from that of a full renormalization.
+        '''
+        if len(fname) != 1 or fname[0] == STDIN or not self.donorm:
+            raise NotImplementedError('Watch requires a single denormalized input file')
+        fname = fname[0]
+        if outfile:
+            outpath = outfile
+            self.is_std = outfile == STDOUT
+        else:
+            outpath = self._derive_path(fname, '-norm')
+
+        # Reuse the paths parsed on construction rather than reparsing
+        (last_stat, seed) = self.watch_seed or (None, [])
+        self._watch_reset(seed)
+        if last_stat is not None:
+            try:
+                self._watch_rebuild()
+                self._write_normed(self._restore_lists(self.watch_tree), outpath)
+            except RuntimeError as err:
+                print(err)
+        try:
+            while True:
+                try:
+                    stat = fname.stat()
+                    if (stat.st_mtime_ns, stat.st_size) != last_stat:
+                        last_stat = (stat.st_mtime_ns, stat.st_size)
+                        with self._open_input(fname) as handle:
+                            updated = self._watch_update(fname, enumerate(handle, 1))
+                    else:
+                        updated = False
+                except OSError:
+                    # Missing while an editor replaces it, retry on the next poll
+                    last_stat = None
+                    updated = False
+                except (ValueError, RuntimeError) as err:
+                    print(err)
+                    updated = False
+                if updated:
+                    self._write_normed(self._restore_lists(self.watch_tree), outpath)
+                time.sleep(interval)
+        except KeyboardInterrupt:
+            pass
+
+    def _watch_reset(self, seed=()):
+        '''
+        Reset in-memory watch state, optionally seeding the line and path
+        state (but not the tree) from (line, path) pairs already parsed
+
+        seed -- Iterable of (stripped line, path) tuples
+        '''
+        self.watch_tree = None
+        self.watch_unique = False
+        self.watch_lines = collections.Counter()
+        self.watch_line_keys = {}
+        self.watch_paths = {}
+        for (line, path) in seed:
+            key = json.dumps(path)
+            self.watch_lines[line] += 1
+            self.watch_line_keys[line] = key
+            if key in self.watch_paths:
+                self.watch_paths[key][1] += 1
+            else:
+                self.watch_paths[key] = [path, 1]
+
+    def _watch_update(self, fname, lines):
+        '''
+        Apply the line level difference between lines and the previously
+        seen version of the watched file to the in-memory pure tree.  Falls
+        back to renormalizing all paths when an edit would overwrite, or
+        uncover a path overwritten by, another path.  Returns True if the
+        tree changed.
+
+        fname -- Watched file name used for error reporting
+        lines -- Iterable of (line number, line) tuples
+        '''
+        new_lines = collections.Counter()
+        linenos = {}
+        for (lineno, line) in lines:
+            line = line.strip()
+            if line:
+                new_lines[line] += 1
+                linenos.setdefault(line, lineno)
+        removed = self.watch_lines - new_lines
+        added = new_lines - self.watch_lines
+        if self.watch_tree is not None and not removed and not added:
+            return False
+        added_paths = self._parse_denormed(fname, [(linenos[x], x) for x in added])
+
+        to_remove = []
+        to_insert = []
+        for (line, count) in removed.items():
+            key = self.watch_line_keys[line]
+            if not new_lines[line]:
+                del self.watch_line_keys[line]
+            self.watch_paths[key][1] -= count
+            if not self.watch_paths[key][1]:
+                to_remove.append(self.watch_paths.pop(key)[0])
+        for ((line, count), path) in zip(added.items(), added_paths):
+            key = json.dumps(path)
+            self.watch_line_keys[line] = key
+            if key in self.watch_paths:
+                self.watch_paths[key][1] += count
+            else:
+                self.watch_paths[key] = [path, count]
+                to_insert.append(path)
+        self.watch_lines = new_lines
+
+        rebuild = self.watch_tree is None or not self.watch_unique
+        if not rebuild:
+            rebuild = not all([self._remove_pure(self.watch_tree, x) for x in to_remove]) or\
+                      not all([self._insert_pure(self.watch_tree, x) for x in to_insert])
+        if rebuild:
+            self._watch_rebuild()
+        return True
+
+    def _watch_rebuild(self):
+        ''' Renormalize the in-memory pure tree from all watched paths '''
+        paths = sorted([x[0] for x in self.watch_paths.values()],
+                       key=lambda a: [str(x) for x in a])
+        try:
+            self.watch_tree = self._normalize_pure(paths)
+        except RuntimeError:
+            # The line state already includes the rejected edit, so force a
+            # full rebuild on the next update
+            self.watch_tree = None
+            raise
+        # Incremental updates are only safe if no path overwrote another
+        self.watch_unique = len(self.denormalize(self.watch_tree)) == len(paths)
+
     def _load_data(self, files):
         '''
         Loads either a standard JSON file (normalized) or a mutable
@@ -287,77 +722,403 @@ class JsonSam(DictSam):
         ret = []
         denormed_input = None
         for fname in files:
-            with open(fname, 'r') as handle:
-                raw_data = handle.read()
-            try:
-                data = json.loads(raw_data)
+            if self.watch_seed is not None:
+                # Stat before reading, so an edit made during the read is
+                # picked up by the first poll
+                stat = fname.stat()
+                self.watch_seed[0] = (stat.st_mtime_ns, stat.st_size)
+            with self._open_input(fname) as handle:
+                (is_denormed, head, data) = self._sniff_format(handle)
+                if is_denormed:
+                    lines = enumerate(itertools.chain(head, handle), 1)
+                    if self.watch_seed is None:
+                        ret += self._parse_denormed(fname, lines)
+                    else:
+                        lines = list(lines)
+                        paths = self._parse_denormed(fname, lines)
+                        # Paths are returned in order, one per non-empty line
+                        texts = [x[1].strip() for x in lines if x[1].strip()]
+                        self.watch_seed[1] += zip(texts, paths)
+                        ret += paths
+                elif data is None:
+                    try:
+                        data = json.loads(''.join(head) + handle.read())
+                    except json.decoder.JSONDecodeError as err:
+                        raise ValueError('{}:{}: {} (column {})'.format(
+                            fname, err.lineno, err.msg, err.colno)) from err
+            if is_denormed:
+                if denormed_input is None:
+                    denormed_input = True
+                elif denormed_input is False:
+                    raise TypeError("{} must be denormalized consistent with other input files"
+                                    .format(fname))
+            else:
                 if not isinstance(data, (dict, list)):
                     raise TypeError("{} must contain root of dictionary or list type"
                                     .format(fname))
-                # Note this can alias a valid single-line path as a normalized input...
                 ret += self.denormalize(data)
                 if denormed_input is None:
                     denormed_input = False
                 elif denormed_input is True:
                     raise TypeError("{} must be normalized consistent with other input files"
                                     .format(fname))
-            except json.decoder.JSONDecodeError:
-                for json_path in raw_data.split('\n'):
-                    if json_path:
-                        try:
-                            ret.append(json.loads(json_path))
-                        except json.decoder.JSONDecodeError:
-                            # Allow denormed prefix for some edge cases (eg onepath)
-                            ret.append(json.loads(json_path[1:]))
-
-                if denormed_input is None:
-                    denormed_input = True
-                elif denormed_input is False:
-                    raise TypeError("{} must be denormalized consistent with other input files"
-                                    .format(fname))
 
         # Unfortunately results in lexicographic sort of integers because all
         # elms need to convert to strings to avoid "int < str" exceptions, and
         # python3 no longer allows passing a comparator function.
         return (denormed_input, sorted(ret, key=lambda a: [str(x) for x in a]))
 
+    @staticmethod
+    @contextlib.contextmanager
+    def _open_input(fname):
+        '''
+        Open an input file for reading as text.  gzip, bz2, xz and zstd
+        compressed input, including stdin, is detected from its magic bytes
+        and decompressed as it is read.
+        '''
+        with open(fname, 'rb') as raw:
+            magic = raw.peek(4)[:4]
+            if magic[:2] == b'\x1f\x8b':
+                import gzip
+                stream = gzip.GzipFile(fileobj=raw)
+            elif magic[:3] == b'BZh':
+                import bz2
+                stream = bz2.BZ2File(raw)
+            elif magic == b'\xfd7zX':
+                import lzma
+                stream = lzma.LZMAFile(raw)
+            elif magic == b'\x28\xb5\x2f\xfd':
+                try:
+                    import zstandard
+                except ImportError as err:
+                    raise ImportError('The zstandard package is required for zstd input ({})'
+                                      .format(fname)) from err
+                stream = zstandard.ZstdDecompressor().stream_reader(raw, closefd=False)
+            else:
+                stream = raw
+            with io.TextIOWrapper(stream) as handle:
+                yield handle
+
+    @staticmethod
+    def _derive_path(fname, tag):
+        '''
+        Derive an output path by appending tag to the file stem, keeping any
+        compression suffix last (eg data.json.gz --> data-norm.json.gz)
+        '''
+        if fname.suffix in COMPRESSED_SUFFIXES:
+            inner = fname.with_suffix('')
+            return fname.parent / (inner.stem + tag + inner.suffix + fname.suffix)
+        return fname.parent / (fname.stem + tag + fname.suffix)
+
+    @staticmethod
+    def _sniff_format(handle):
+        '''
+        Decide whether an input is denormalized from its first lines only,
+        without speculatively parsing the whole input.  Returns a tuple of
+        (is_denormed, lines_consumed, data), where data is the parsed input
+        if sniffing already parsed all of it (a single line root list, eg
+        compact output) and None otherwise.
+
+        A denormalized file either starts with a single character prefixed
+        path (as accepted by _parse_denormed, eg "_" or diff patch "-"/"+"),
+        or starts with a "[" line followed by more lines.  Normalized JSON
+        cannot have a complete value on the first line followed by further
+        content.  If the first line is a malformed path, the input is still
+        denormalized when the second line is a complete path, so that the
+        bad lines are reported by line number.
+        '''
+        is_path = lambda x: isinstance(x, list) and len(x) > 1
+        head = []
+        first = None
+        data = None
+        for line in handle:
+            head.append(line)
+            if not line.strip():
+                continue
+            if first is not None:
+                if data is not None:
+                    return (True, head, None)
+                # A lone "[" opens an indented normalized root list
+                if first == '[':
+                    return (False, head, None)
+                second = line.strip()
+                try:
+                    second = json.loads(second if second[0] == '[' else second[1:])
+                except json.decoder.JSONDecodeError:
+                    return (False, head, None)
+                return (is_path(second), head, None)
+            first = line.strip()
+            if first[0] != '[':
+                return (first[0] == '_' or first[1:].lstrip()[:1] == '[', head, None)
+            try:
+                data = json.loads(first)
+            except json.decoder.JSONDecodeError:
+                continue
+            if not isinstance(data, list):
+                return (False, head, None)
+        # Empty input is treated as an empty set of paths
+        return (first is None, head, data)
+
+    @staticmethod
+    def _parse_denormed(fname, lines):
+        '''
+        Parse denormalized paths in batches of DENORM_BATCH_LINES lines,
+        falling back to line by line parsing to localize errors.  All bad
+        lines are reported together with their line numbers.  Paths are
+        returned in input order.
+
+        fname -- Input file name used for error reporting
+        lines -- Iterable of (line number, line) tuples
+        '''
+        paths = []
+        errors = []
+
+        def parse_line(lineno, line):
+            try:
+                path = json.loads(line)
+            except json.decoder.JSONDecodeError as err:
+                try:
+                    # Allow denormed prefix for some edge cases (eg onepath)
+                    path = json.loads(line[1:])
+                except json.decoder.JSONDecodeError:
+                    errors.append('{}:{}: {} (column {})'.format(fname, lineno, err.msg,
+                                                                  err.colno))
+                    return
+            if not isinstance(path, list) or len(path) < 2:
+                errors.append('{}:{}: Path must be a list of at least two elements'
+                              .format(fname, lineno))
+                return
+            paths.append(path)
+
+        def parse_batch(batch):
+            try:
+                parsed = json.loads('[' + ','.join([x[1] for x in batch]) + ']')
+                if len(parsed) == len(batch) and \
+                   all([isinstance(x, list) and len(x) > 1 for x in parsed]):
+                    paths.extend(parsed)
+                    return
+            except json.decoder.JSONDecodeError:
+                pass
+            for (lineno, line) in batch:
+                parse_line(lineno, line)
+
+        batch = []
+        for (lineno, line) in lines:
+            line = line.strip()
+            if not line:
+                continue
+            if line[0] != '[':
+                # Prefixed lines never take the batch path
+                if batch:
+                    parse_batch(batch)
+                    batch = []
+                parse_line(lineno, line)
+                continue
+            batch.append((lineno, line))
+            if len(batch) == DENORM_BATCH_LINES:
+                parse_batch(batch)
+                batch = []
+        if batch:
+            parse_batch(batch)
+
+        if errors:
+            raise ValueError('Invalid denormalized paths:\n' + '\n'.join(errors))
+        return paths
+
+    def _write_split(self, fname, outfile, num_shards, strategy):
+        '''
+        Distribute paths across num_shards normalized JSON files, optionally
+        normalizing the shards in parallel worker processes.
+        '''
+        if outfile == STDOUT or (fname[0] == STDIN and not outfile):
+            raise NotImplementedError('Output file (-o) required for split')
+        if outfile:
+            mkfn = lambda n: self._derive_path(outfile, '{:03d}'.format(n))
+        else:
+            mkfn = lambda n: self._derive_path(fname[0], '-split{:03d}'.format(n))
+
+        if self.enforce_unique:
+            # Overwrites may span shards, so check all paths up front
+            self._check_unique(self.denorm_accum)
+        shards = self.shard_paths(self.denorm_accum, num_shards, strategy)
+        outpaths = [mkfn(n) for n in range(num_shards)]
+        outpaths = [x if x.suffix else x.with_suffix('.json') for x in outpaths]
+        work = [(x, outpaths[n], self.enforce_unique, self.indent, self.sort_keys)
+                for (n, x) in enumerate(shards)]
+        if self.jobs > 1:
+            import multiprocessing
+            with multiprocessing.Pool(min(self.jobs, num_shards)) as pool:
+                outpaths = pool.map(_write_norm_shard, work)
+        else:
+            outpaths = [_write_norm_shard(x) for x in work]
+        for outpath in outpaths:
+            print("Updated JSON file written to {}".format(outpath))
+
+    @staticmethod
+    def _open_output(outpath):
+        '''
+        Open an output file for writing as text, compressed according to its
+        gz, bz2, xz or zst suffix.  Compression modules are imported on demand.
+        '''
+        suffix = outpath.suffix
+        if suffix == '.gz':
+            import gzip
+            return gzip.open(outpath, 'wt')
+        if suffix == '.bz2':
+            import bz2
+            return bz2.open(outpath, 'wt')
+        if suffix == '.xz':
+            import lzma
+            return lzma.open(outpath, 'wt')
+        if suffix == '.zst':
+            try:
+                import zstandard
+            except ImportError as err:
+                raise ImportError('The zstandard package is required for .zst output') from err
+            writer = zstandard.ZstdCompressor().stream_writer(open(outpath, 'wb'))
+            return io.TextIOWrapper(writer)
+        return open(outpath, 'w')
+
+    @classmethod
+    def dump_normed(cls, data, outpath, indent=2, sort_keys=False):
+        '''
+        Serialize normalized data to a json file.  The encoder output is
+        streamed to the file in OUTPUT_CHUNK_SIZE chunks rather than built
+        as a single string.
+
+        indent -- Indent level, None for compact output
+        sort_keys -- Sort dictionary keys
+        '''
+        if indent is None:
+            encoder = json.JSONEncoder(separators=(',', ':'), sort_keys=sort_keys)
+            pieces = cls._iterencode_compact(encoder, data)
+        else:
+            # Indented output always uses the pure python encoder
+            encoder = json.JSONEncoder(indent=indent, sort_keys=sort_keys)
+            pieces = encoder.iterencode(data)
+        with cls._open_output(outpath) as handle:
+            chunks = []
+            size = 0
+            for chunk in pieces:
+                chunks.append(chunk)
+                size += len(chunk)
+                if size >= OUTPUT_CHUNK_SIZE:
+                    handle.write(''.join(chunks))
+                    chunks = []
+                    size = 0
+            handle.write(''.join(chunks))
+
+    @classmethod
+    def _iterencode_compact(cls, encoder, data):
+        '''
+        Compactly encode data, descending into containers until a subtree
+        has at most COMPACT_ENCODE_ITEMS items and can be encoded in one
+        piece.  Unlike iterencode(), encode() uses the C accelerated encoder,
+        and descending keeps memory bounded however large a single child is.
+        '''
+        if cls._count_items(data, COMPACT_ENCODE_ITEMS) <= COMPACT_ENCODE_ITEMS:
+            yield encoder.encode(data)
+        elif isinstance(data, dict):
+            items = data.items()
+            if encoder.sort_keys:
+                items = sorted(items, key=lambda x: x[0])
+            sep = '{'
+            for (key, value) in items:
+                # Encode the key in a dict so it is coerced as json does
+                yield sep + encoder.encode({key: None})[1:-len(':null}')] + ':'
+                yield from cls._iterencode_compact(encoder, value)
+                sep = ','
+            yield '}'
+        else:
+            sep = '['
+            for value in data:
+                yield sep
+                yield from cls._iterencode_compact(encoder, value)
+                sep = ','
+            yield ']'
+
+    @staticmethod
+    def _count_items(data, limit):
+        '''
+        Count the dict and list items in data, stopping once past limit
+        '''
+        count = 0
+        stack = [data]
+        while stack and count <= limit:
+            node = stack.pop()
+            if isinstance(node, dict):
+                node = node.values()
+            elif not isinstance(node, list):
+                continue
+            count += len(node)
+            stack += [x for x in node if isinstance(x, (dict, list))]
+        return count
+
     def _write_normed(self, data, outpath):
         ''' Write normalized json file to disk '''
-        mixed_dict = data
-        out_json = json.dumps(mixed_dict, indent=2)
-
         if not self.is_std and not outpath.suffix:
             outpath = outpath.with_suffix('.json')
-        with open(outpath, 'w') as handle:
-            handle.write(out_json)
+        self.dump_normed(data, outpath, self.indent, self.sort_keys)
         if not self.is_std:
             print("Updated JSON file written to {}".format(outpath))
 
+    @staticmethod
+    def _write_lines(handle, lines):
+        ''' Write newline separated lines to handle in OUTPUT_CHUNK_SIZE chunks '''
+        chunks = []
+        size = 0
+        sep = ''
+        for line in lines:
+            chunks.append(line)
+            size += len(line)
+            if size >= OUTPUT_CHUNK_SIZE:
+                handle.write(sep + '\n'.join(chunks))
+                (chunks, size, sep) = ([], 0, '\n')
+        if chunks:
+            handle.write(sep + '\n'.join(chunks))
+
     def _write_denormed(self, outpath):
         ''' Write denormalized json file to disk '''
         denormed = self.denorm_accum
-        out_txt = ''
-        for path in denormed:
-            out_txt += json.dumps(path) + '\n'
-        if len(out_txt) > 0:
-            out_txt = out_txt[:-1]
-        if len(denormed) == 1:
-            # Disambiguate from valid single JSON input list
-            out_txt = '_' + out_txt
 
         if not self.is_std and not outpath.suffix:
             outpath = outpath.with_suffix('.json')
-        with open(outpath, 'w') as handle:
-            handle.write(out_txt)
+        with self._open_output(outpath) as handle:
+            if len(denormed) == 1:
+                # Disambiguate from valid single JSON input list
+                handle.write('_')
+            self._write_lines(handle, (json.dumps(x) for x in denormed))
         if not self.is_std:
             print("Make edits to {} and then rerun with modified file to generate "
                   "updated JSON output"
                   .format(outpath))
 
+    def _write_patch(self, patch, outpath):
+        ''' Write denormalized patch of "-" and "+" prefixed paths to disk '''
+        if not self.is_std and not outpath.suffix:
+            outpath = outpath.with_suffix('.json')
+        with self._open_output(outpath) as handle:
+            self._write_lines(handle, (op + json.dumps(path) for (op, path) in patch))
+        if not self.is_std:
+            print("Denormalized patch written to {}".format(outpath))
+
+def _positive_int(value):
+    ''' argparse type for integers of at least 1 '''
+    num = int(value)
+    if num < 1:
+        raise argparse.ArgumentTypeError('must be at least 1, got {}'.format(value))
+    return num
+
 def main():
     ''' CLI entry point '''
     arg_parser = argparse.ArgumentParser()
     group = arg_parser.add_mutually_exclusive_group()
+    arg_parser.add_argument('-C', '--compact', dest='compact', required=False,
+                            action='store_true', default=False,
+                            help='Write compact (unindented) normalized output')
+    group.add_argument('-d', '--diff', dest='set_op', required=False, default=None,
+                       action='store_const', const='diff',
+                       help='Diff (write denormalized patch of removed/added paths)')
     group.add_argument('-e', dest='set_op', required=False, default=None,
                        action='store_const', const='except',
                        help='Except (subtract/remove)')
@@ -373,12 +1134,32 @@ def main():
     group.add_argument('-i', dest='set_op', required=False, default=None,
                        action='store_const', const='intersect',
                        help='Intersect')
+    arg_parser.add_argument('-j', dest='jobs', required=False,
+                            default=1, type=_positive_int,
+                            help='Number of worker processes for normalization')
+    arg_parser.add_argument('-K', '--sort-keys', dest='sort_keys', required=False,
+                            action='store_true', default=False,
+                            help='Sort keys of normalized output')
+    arg_parser.add_argument('-M', '--merge', dest='merge', required=False,
+                            action='store_true', default=False,
+                            help='Merge inputs into a single normalized output')
     arg_parser.add_argument('-o', dest='outfile', required=False,
                             default=None, type=Path,
-                            help='Output JSON file (autogenerated name if omitted)')
+                            help='Output JSON file (autogenerated name if omitted). '
+                            'Compressed if suffix is .gz, .bz2, .xz or .zst')
+    arg_parser.add_argument('-S', '--split', dest='num_shards', required=False,
+                            default=None, type=_positive_int,
+                            help='Split paths into N normalized output files')
+    arg_parser.add_argument('--strategy', dest='strategy', required=False,
+                            default='roundrobin', choices=SPLIT_STRATEGIES,
+                            help='Split strategy: round-robin paths, hash of top-level '
+                            'key, or balance shard size (default roundrobin)')
     group.add_argument('-u', dest='set_op', required=False, default=None,
                        action='store_const', const='union',
                        help='Union (add/merge)')
+    arg_parser.add_argument('-w', '--watch', dest='watch', required=False,
+                            action='store_true', default=False,
+                            help='Watch denormalized input and renormalize on each change')
     arg_parser.add_argument('infiles', nargs='*', default=[STDIN],
                             help='Input files ("-" for last file outputs to stdout)')
     args = arg_parser.parse_args()
@@ -392,8 +1173,17 @@ def main():
     else:
         outfile = args.outfile
 
-    json_sam = JsonSam(infiles, infileaux, args.ignore_leaves, args.enforce_unique)
-    json_sam.process(infiles, infileaux, outfile, args.set_op)
+    try:
+        json_sam = JsonSam(infiles, infileaux, args.ignore_leaves, args.enforce_unique,
+                           args.compact, args.sort_keys, args.jobs, args.watch)
+    except ValueError as err:
+        # Malformed input, report without a traceback
+        sys.exit(str(err))
+    if args.watch:
+        json_sam.watch(infiles, outfile)
+    else:
+        json_sam.process(infiles, infileaux, outfile, args.set_op, args.merge,
+                         args.num_shards, args.strategy)
 
 if __name__ == "__main__":
     main()
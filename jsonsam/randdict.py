@@ -28,13 +28,14 @@ import random
 import string
 import argparse
 from pathlib import Path
-from faker import Faker
 
 class DictGen:
     '''
     Random dictionary generator
     '''
     def __init__(self, seed=7):
+        # Faker is slow to import, so defer it until a generator is created
+        from faker import Faker
         self.fake = Faker()
         random.seed(seed)
         Faker.seed(seed)
@@ -21,8 +21,14 @@ SOFTWARE.
 '''
 
 import re
+import sys
+import bz2
+import gzip
+import lzma
 import json
+import time
 import random
+import signal
 import operator
 import tempfile
 import subprocess as sp
@@ -32,7 +38,7 @@ from deepdiff import DeepDiff
 import pytest
 
 from jsonsam import __version__
-from jsonsam import DictSam, DictGen
+from jsonsam import DictSam, DictGen, JsonSam
 
 MYWD = Path().absolute()
 SCRIPTDIR = Path(__file__).parent.absolute()
@@ -41,6 +47,9 @@ SDIR = SCRIPTDIR / 'data'
 CLI_PY = SCRIPTDIR.parents[0] / 'jsonsam' / 'jsonsam.py'
 DICT_PY = SCRIPTDIR.parents[0] / 'jsonsam' / 'randdict.py'
 
+# Generous bound on cumulative "import jsonsam" time (Faker alone exceeds it)
+IMPORT_BUDGET_US = 150000
+
 class Utils:
     @staticmethod
     def run_rand_ops(seed, opfn):
@@ -73,6 +82,22 @@ class TestJsonSam:
         print("Using PRNG seed {}".format(seed))
         cls.utils = Utils
 
+    def test_import_time(self):
+        # Heavy optional modules must only load when used
+        cmd = [sys.executable, '-c', 'import sys, jsonsam, jsonsam.jsonsam; '
+               'print(" ".join(sorted(sys.modules)))']
+        modules = sp.check_output(cmd, cwd=SCRIPTDIR.parents[0]).decode().split()
+        for module in ['faker', 'multiprocessing', 'numpy', 'deepdiff']:
+            assert module not in modules
+
+        cmd = [sys.executable, '-X', 'importtime', '-c', 'import jsonsam']
+        importtime = sp.run(cmd, stderr=sp.PIPE, cwd=SCRIPTDIR.parents[0],
+                            check=True).stderr.decode()
+        cumulative_us = [int(x.split('|')[1]) for x in importtime.split('\n')
+                         if x.endswith('| jsonsam')][0]
+        print("jsonsam import time {}us".format(cumulative_us))
+        assert cumulative_us < IMPORT_BUDGET_US
+
     def test_gen_dict(self):
         test_dict = DictGen().gen_fake_dict()
         assert len(test_dict.keys()) != 0
@@ -170,6 +195,409 @@ class TestJsonSam:
         with pytest.raises(RuntimeError):
             dict_sam.normalize(denorm_data)
 
+    @pytest.mark.parametrize("stem", ['test', 'test_root_list'])
+    def test_normalize_parallel(self, stem):
+        with open(SDIR / (stem + '.json'), 'r') as handle:
+            test_data = json.load(handle)
+        denorm = DictSam(test_data).denormalize()
+        root_key = denorm[0][0]
+        denorm += [[root_key, "floor", "board", 0, "CRUD"],
+                   [root_key, "floor", "board", 0, "set", 0.21]]
+        serial = DictSam.normalize(denorm)
+        parallel = DictSam.normalize(denorm, jobs=3)
+        assert isinstance(parallel, type(test_data))
+        # Key order must match too
+        assert json.dumps(serial) == json.dumps(parallel)
+
+        DictSam(enforce_unique=True)
+        with pytest.raises(RuntimeError):
+            DictSam.normalize(denorm, jobs=3)
+        DictSam.enforce_unique = False
+
+    def test_columnar(self):
+        pytest.importorskip('numpy')
+        from jsonsam.columnar import ColumnarSam
+        test_dict = DictGen().gen_fake_dict(breadth_rng=(2, 4), depth_rng=(3, 5))
+        dict_sam = DictSam(test_dict)
+        denorm = dict_sam.denormalize()
+        cols = ColumnarSam(dict_sam)
+        assert len(cols) == len(denorm)
+
+        is_number = lambda x: isinstance(x, (int, float)) and not isinstance(x, bool)
+        reference = DictSam([x for x in denorm if is_number(x[-1]) and x[-1] > 1000],
+                            denormed=True)
+        assert cols.select(cols.number > 1000) == reference
+
+        top_key = denorm[0][0]
+        pattern = '[0-9]+ [A-Z]'
+        reference = [x for x in denorm if x[0] == top_key and isinstance(x[-1], str) and
+                     re.search(pattern, x[-1])]
+        assert len(reference) != 0
+        res = cols.select(cols.prefix(top_key) & cols.match(pattern))
+        assert res == DictSam(reference, denormed=True)
+
+        assert not cols.prefix(top_key, 'no such key').any()
+        assert cols.prefix().all()
+
+        cols = ColumnarSam(DictSam({'a': 'xy', 'b': [1, 'xy', 'y' * 10000, None]}))
+        assert cols.match('^x').tolist() == [True, False, True, False, False]
+        assert not ColumnarSam(DictSam({'a': 1})).match('.*').any()
+
+    @pytest.mark.parametrize("strategy", ['roundrobin', 'hash', 'size'])
+    def test_split(self, strategy):
+        stringify_list = lambda ll: [json.dumps(x) for x in ll]
+        test_dict = DictGen().gen_fake_dict(breadth_rng=(2, 4), depth_rng=(3, 5))
+        dict_sam = DictSam(test_dict)
+        shards = dict_sam.split(5, strategy)
+        assert len(shards) == 5
+        reference = set(stringify_list(dict_sam.denormalize()))
+        res_denorm_set = set()
+        for shard in shards:
+            res_denorm_set |= set(stringify_list(shard.denormalize()))
+        # Lists are never split, so no Nones are padded in
+        assert reference == res_denorm_set
+
+        if strategy == 'hash':
+            top_keys = [set(x.get_data().keys()) for x in shards]
+            assert sum([len(x) for x in top_keys]) == len(test_dict)
+
+    def test_diff(self):
+        test_dict_a = DictGen().gen_fake_dict()
+        dict_sam_a = DictSam(test_dict_a)
+        assert len(dict_sam_a.diff(dict_sam_a)) == 0
+
+        denorm = dict_sam_a.denormalize()
+        denorm_b = [x[:-1] + ['changed'] for x in denorm[:3]] + denorm[4:] + [['NEW', 'PATH']]
+        patch = dict_sam_a.diff(DictSam(denorm_b, denormed=True))
+        removed = [x[1] for x in patch if x[0] == '-']
+        added = [x[1] for x in patch if x[0] == '+']
+        assert len(removed) == 4
+        assert len(added) == 4
+        assert denorm[3] in removed
+        assert ['NEW', 'PATH'] in added
+        # Changed leaves are paired, removal first
+        for (idx, (oper, path)) in enumerate(patch):
+            if oper == '+' and path[-1] == 'changed':
+                assert patch[idx - 1][0] == '-'
+                assert patch[idx - 1][1][:-1] == path[:-1]
+
+    def test_cli_json_diff(self):
+        cmd = [CLI_PY, '-F', SDIR / 'simple_aux.json', '-d', SDIR / 'simple.json', '-']
+        patch = sp.check_output(cmd).decode().split('\n')
+        assert len(patch) == 9
+        assert '-["beer", 3.14]' in patch
+        assert patch[patch.index('-["beer", 3.14]') + 1] == '+["beer", 3.1415]'
+        assert '+["NEW", "PATH"]' in patch
+
+        cmd.insert(1, '-I') # Enable ignore leaves
+        patch = sp.check_output(cmd).decode().split('\n')
+        assert len(patch) == 7
+        assert '-["beer", 3.14]' not in patch
+
+    def test_diff_lazy(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            json_sam = JsonSam([SDIR / 'simple.json'], [SDIR / 'simple_aux.json'])
+            json_sam.process([SDIR / 'simple.json'], [SDIR / 'simple_aux.json'],
+                             Path(tmpdir) / 'patch.json', 'diff')
+            with open(Path(tmpdir) / 'patch.json', 'r') as handle:
+                assert '+["NEW", "PATH"]' in handle.read().split('\n')
+        # Diff works on the paths alone, neither input is normalized
+        assert json_sam._normed is None
+        assert json_sam.json_sam_aux._normed is None
+
+    def test_watch_update(self):
+        with open(SDIR / 'simple.json', 'r') as handle:
+            denorm = [json.dumps(x) for x in DictSam(json.load(handle)).denormalize()]
+        edits = [denorm,
+                 # Leaf change, removal and addition
+                 [x.replace('3.14', '2.71') for x in denorm[2:]] + ['["jack", 0, "bean", 941]'],
+                 # Overwrite an existing leaf, then undo it
+                 denorm + ['["young", "guts", "but", "dog"]'],
+                 denorm,
+                 # Duplicate and reformatted lines
+                 denorm + denorm[:2] + ['[ "Bad" ,true ]'],
+                 denorm[1:]]
+        with tempfile.NamedTemporaryFile('w', suffix='.json') as handle:
+            handle.write('\n'.join(denorm))
+            handle.flush()
+            json_sam = JsonSam([Path(handle.name)])
+        json_sam._watch_reset()
+        for edit in edits:
+            assert json_sam._watch_update('edit', enumerate(edit, 1))
+            reference = DictSam([json.loads(x) for x in edit], denormed=True)
+            ddiff = DeepDiff(reference.get_data(),
+                             json_sam._restore_lists(json_sam.watch_tree))
+            assert len(ddiff) == 0
+        assert not json_sam._watch_update('edit', enumerate(edits[-1], 1))
+
+        with pytest.raises(ValueError):
+            json_sam._watch_update('edit', enumerate(denorm + ['["bad"'], 1))
+
+        # A rejected overwrite must not leave the tree stale
+        json_sam = JsonSam([SDIR / 'simple.json'], enforce_unique=True)
+        json_sam._watch_reset()
+        edits = [['["c", 2]', '["a", "b", 1]'],
+                 ['["c", 2]', '["a", "b", 1]', '["a", "b", "x", 3]'],
+                 ['["c", 2]', '["a", "b", "x", 3]']]
+        assert json_sam._watch_update('edit', enumerate(edits[0], 1))
+        with pytest.raises(RuntimeError):
+            json_sam._watch_update('edit', enumerate(edits[1], 1))
+        assert json_sam._watch_update('edit', enumerate(edits[2], 1))
+        assert json_sam._restore_lists(json_sam.watch_tree) == {'c': 2, 'a': {'b': {'x': 3}}}
+        DictSam.enforce_unique = False
+
+    def test_watch_seed(self, monkeypatch):
+        with open(SDIR / 'simple.json', 'r') as handle:
+            denorm = [json.dumps(x) for x in DictSam(json.load(handle)).denormalize()]
+        with tempfile.NamedTemporaryFile('w', suffix='.json') as handle:
+            handle.write('\n'.join(denorm + denorm[:1]))
+            handle.flush()
+            json_sam = JsonSam([Path(handle.name)], watch=True)
+        (last_stat, seed) = json_sam.watch_seed
+        assert last_stat is not None
+        json_sam._watch_reset(seed)
+        json_sam._watch_rebuild()
+        assert json_sam._restore_lists(json_sam.watch_tree) == json_sam.get_data()
+
+        # The seeded state matches the file, so only edited lines are parsed
+        parsed = []
+        parse = JsonSam._parse_denormed
+        monkeypatch.setattr(JsonSam, '_parse_denormed',
+                            staticmethod(lambda f, x: parsed.append(len(x)) or parse(f, x)))
+        edit = denorm[1:] + ['["NEW", "PATH"]']
+        assert not json_sam._watch_update('edit', enumerate(denorm + denorm[:1], 1))
+        assert json_sam._watch_update('edit', enumerate(edit, 1))
+        assert parsed == [1]
+        reference = DictSam([json.loads(x) for x in edit], denormed=True)
+        assert json_sam._restore_lists(json_sam.watch_tree) == reference.get_data()
+
+    def test_cli_watch_replace(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            (inpath, outpath) = (Path(tmpdir) / 'in.json', Path(tmpdir) / 'out.json')
+            with open(inpath, 'w') as handle:
+                handle.write('["a", 1]\n["b", 2]\n')
+
+            def wait_for(data):
+                for _ in range(100):
+                    try:
+                        with open(outpath, 'r') as handle:
+                            if json.load(handle) == data:
+                                return True
+                    except (OSError, ValueError):
+                        pass
+                    time.sleep(0.1)
+                return False
+
+            proc = sp.Popen([CLI_PY, '-w', '-o', outpath, inpath], stdout=sp.DEVNULL,
+                            stderr=sp.PIPE)
+            try:
+                assert wait_for({'a': 1, 'b': 2})
+                # Editors may delete the file before writing the new version
+                inpath.unlink()
+                time.sleep(1)
+                with open(inpath, 'w') as handle:
+                    handle.write('["a", 1]\n["b", 3]\n')
+                assert wait_for({'a': 1, 'b': 3})
+                assert proc.poll() is None
+            finally:
+                proc.send_signal(signal.SIGINT)
+                proc.wait(timeout=10)
+            assert 'Traceback' not in proc.stderr.read().decode()
+
+    @pytest.mark.parametrize("suffix", ['.json', '.gz', '.bz2', '.xz', '.zst'])
+    def test_dump_normed(self, suffix):
+        if suffix == '.zst':
+            zstandard = pytest.importorskip('zstandard')
+        test_dict = DictGen().gen_fake_dict()
+        with tempfile.TemporaryDirectory() as tmpdir:
+            outpath = Path(tmpdir) / ('out' + suffix)
+            JsonSam.dump_normed(test_dict, outpath, indent=None, sort_keys=True)
+            if suffix == '.zst':
+                with open(outpath, 'rb') as handle:
+                    raw = zstandard.ZstdDecompressor().stream_reader(handle).read()
+            else:
+                opener = {'.gz': gzip.open, '.bz2': bz2.open, '.xz': lzma.open}.get(suffix, open)
+                with opener(outpath, 'rb') as handle:
+                    raw = handle.read()
+        assert raw.decode() == json.dumps(test_dict, separators=(',', ':'), sort_keys=True)
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            big = {'k': [{'a': list(range(3000)), 'b': {str(x): x for x in range(3000)}}]}
+            for data in [[test_dict, [], 1, None], {}, [], 'leaf', {'b': [1], 'a': {}}, big]:
+                JsonSam.dump_normed(data, Path(tmpdir) / 'out.json', indent=None)
+                with open(Path(tmpdir) / 'out.json', 'r') as handle:
+                    assert handle.read() == json.dumps(data, separators=(',', ':'))
+
+    @pytest.mark.parametrize("suffix", ['.gz', '.bz2', '.xz', '.zst'])
+    def test_compressed_input(self, suffix):
+        with open(SDIR / 'test.json', 'r') as handle:
+            test_dict = json.load(handle)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            tmpdir = Path(tmpdir)
+            if suffix == '.zst':
+                zstandard = pytest.importorskip('zstandard')
+                with open(tmpdir / 'test.json.zst', 'wb') as handle:
+                    handle.write(zstandard.ZstdCompressor().compress(json.dumps(test_dict)
+                                                                     .encode()))
+            else:
+                opener = {'.gz': gzip.open, '.bz2': bz2.open, '.xz': lzma.open}[suffix]
+                with opener(tmpdir / ('test.json' + suffix), 'wt') as handle:
+                    json.dump(test_dict, handle, indent=2)
+            json_sam = JsonSam([tmpdir / ('test.json' + suffix)])
+            assert not json_sam.donorm
+            json_sam.process([tmpdir / ('test.json' + suffix)], [None])
+            denorm_path = tmpdir / ('test-denorm.json' + suffix)
+            assert denorm_path.exists()
+            json_sam = JsonSam([denorm_path])
+            assert json_sam.donorm
+
+        ddiff = DeepDiff(test_dict, json_sam.get_data())
+        assert len(ddiff) == 0
+
+    def test_cli_json_std_gz(self):
+        with open(SDIR / 'test.json', 'rb') as handle:
+            compressed = gzip.compress(handle.read())
+        cmdout = sp.check_output([CLI_PY], input=compressed)
+        cmdout = sp.check_output([CLI_PY], input=gzip.compress(cmdout))
+        with open(SDIR / 'test.json', 'r') as hand0:
+            test_dict = json.load(hand0)
+
+        ddiff = DeepDiff(test_dict, json.loads(cmdout))
+        assert len(ddiff) == 0
+
+    def test_cli_json_compact_gz(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            outpath = Path(tmpdir) / 'test.json.gz'
+            cmd = [CLI_PY, '-C', '-K', '-o', outpath, SDIR / 'test-denorm.json']
+            sp.run([CLI_PY, SDIR / 'test.json'], check=True)
+            sp.run(cmd, check=True)
+            with open(SDIR / 'test.json', 'r') as hand0, gzip.open(outpath, 'rt') as hand1:
+                test_dict = json.load(hand0)
+                raw = hand1.read()
+        assert '\n' not in raw
+        ddiff = DeepDiff(test_dict, json.loads(raw))
+        assert len(ddiff) == 0
+
+    @pytest.mark.parametrize("strategy", ['roundrobin', 'hash', 'size'])
+    def test_cli_json_split_merge(self, strategy):
+        test_dict = {"k": [5, "ABC", {"Z": 1}, 7, 3.5, "x"], "m": {"a": [1, 2, 3, 4]},
+                     "n": {"b": 1, "c": {"d": [None, 2]}}, "o": "p"}
+        with tempfile.TemporaryDirectory() as tmpdir:
+            with open(Path(tmpdir) / 'in.json', 'w') as handle:
+                json.dump(test_dict, handle)
+            for (infile, num_shards) in [(Path(tmpdir) / 'in.json', '3'),
+                                         (SDIR / 'test.json', '5')]:
+                for shard in Path(tmpdir).glob('shard*.json'):
+                    shard.unlink()
+                cmd = [CLI_PY, '-S', num_shards, '--strategy', strategy, '-j', '2',
+                       '-o', Path(tmpdir) / 'shard.json', infile]
+                sp.run(cmd, check=True)
+                shards = sorted(Path(tmpdir).glob('shard*.json'))
+                assert len(shards) == int(num_shards)
+                cmd = [CLI_PY, '-M', '-o', Path(tmpdir) / 'merged.json'] + shards
+                sp.run(cmd, check=True)
+                with open(infile, 'r') as hand0,\
+                     open(Path(tmpdir) / 'merged.json', 'r') as hand1:
+                    ddiff = DeepDiff(json.load(hand0), json.load(hand1))
+                assert len(ddiff) == 0
+
+            for opts in [['-S', '0'], ['-S', '-1'], ['-S', '2', '-j', '0'],
+                         ['-S', '2', '-j', '-3']]:
+                cmd = [CLI_PY] + opts + ['-o', Path(tmpdir) / 'shard.json',
+                                         Path(tmpdir) / 'in.json']
+                proc = sp.run(cmd, stderr=sp.PIPE, check=False)
+                assert proc.returncode == 2
+                assert 'Traceback' not in proc.stderr.decode()
+
+    @pytest.mark.parametrize("compact", [False, True])
+    def test_cli_json_split_sort_keys(self, compact):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            with open(Path(tmpdir) / 'in.json', 'w') as handle:
+                handle.write('["a", 0, 1]\n["a", "b", 2]\n')
+            cmd = [CLI_PY, '-S', '1', '-K', '-o', Path(tmpdir) / 'shard.json',
+                   Path(tmpdir) / 'in.json']
+            if compact:
+                cmd.insert(1, '-C')
+            sp.run(cmd, check=True)
+            with open(Path(tmpdir) / 'shard000.json', 'r') as handle:
+                assert json.load(handle) == {'a': {'0': 1, 'b': 2}}
+
+    def test_split_lazy(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            json_sam = JsonSam([SDIR / 'test.json'])
+            json_sam.process([SDIR / 'test.json'], [None], Path(tmpdir) / 'shard.json',
+                             num_shards=2)
+            assert json_sam._normed is None
+
+            with open(Path(tmpdir) / 'dup.json', 'w') as handle:
+                handle.write('["a", "b", 1]\n["a", "b", "x", 3]\n')
+            json_sam = JsonSam([Path(tmpdir) / 'dup.json'], enforce_unique=True)
+            with pytest.raises(RuntimeError):
+                json_sam.process([Path(tmpdir) / 'dup.json'], [None],
+                                 Path(tmpdir) / 'shard.json', num_shards=2)
+        DictSam.enforce_unique = False
+
+    @pytest.mark.parametrize("text,denormed", [('{\n  "a": 1\n}', False),
+                                               ('[\n  1\n]', False),
+                                               ('[1, 2]\n', False),
+                                               ('[\n  ["a", 1]\n]', False),
+                                               ('[["a", 1],\n["b", 2]]', False),
+                                               ('_["a", 1]', True),
+                                               ('-["a", 1]\n+["a", 2]\n', True),
+                                               ('["a", 1]\n["b", 2]\n', True),
+                                               ('', True)])
+    def test_sniff_format(self, text, denormed):
+        with tempfile.NamedTemporaryFile('w', suffix='.json') as handle:
+            handle.write(text)
+            handle.flush()
+            json_sam = JsonSam([Path(handle.name)])
+        assert json_sam.donorm == denormed
+
+    def test_sniff_parse_once(self, monkeypatch):
+        import jsonsam.jsonsam
+        with open(SDIR / 'test_root_list.json', 'r') as handle:
+            text = json.dumps(json.load(handle), separators=(',', ':'))
+        parsed = []
+        loads = json.loads
+        with tempfile.NamedTemporaryFile('w', suffix='.json') as handle:
+            handle.write(text + '\n')
+            handle.flush()
+            monkeypatch.setattr(jsonsam.jsonsam.json, 'loads',
+                                lambda x, **kw: parsed.append(len(x)) or loads(x, **kw))
+            json_sam = JsonSam([Path(handle.name)])
+        assert not json_sam.donorm
+        # The compact root list is only parsed while sniffing
+        assert len([x for x in parsed if x >= len(text)]) == 1
+
+    def test_cli_json_bad_lines(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            fname = Path(tmpdir) / 'bad.json'
+            with open(fname, 'w') as handle:
+                handle.write('["a", 1]\n["b", 2\n["c", 3]\n\n["d"]\n["e", 5]\n')
+            proc = sp.run([CLI_PY, fname], stderr=sp.PIPE, check=False)
+            assert proc.returncode != 0
+            errors = proc.stderr.decode()
+            assert 'bad.json:2:' in errors
+            assert 'bad.json:5:' in errors
+            assert 'Traceback' not in errors
+
+            # Bad first line
+            with open(fname, 'w') as handle:
+                handle.write('["a", 1\n["b", 2]\n["c" 3]\n')
+            proc = sp.run([CLI_PY, fname], stderr=sp.PIPE, check=False)
+            errors = proc.stderr.decode()
+            assert 'bad.json:1:' in errors
+            assert 'bad.json:3:' in errors
+
+            # Malformed normalized input names the file
+            with open(fname, 'w') as handle:
+                handle.write('{\n  "a": 1\n  "b": 2\n}\n')
+            proc = sp.run([CLI_PY, fname], stderr=sp.PIPE, check=False)
+            assert proc.returncode != 0
+            errors = proc.stderr.decode()
+            assert 'bad.json:3:' in errors
+            assert 'Traceback' not in errors
+
     @pytest.mark.parametrize("stem", ['test', 'test_root_list', 'onepath'])
     def test_cli_json_ident(self, stem):
         cmd = [CLI_PY, SDIR / (stem + '.json')]